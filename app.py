@@ -1,20 +1,110 @@
+import atexit
+import binascii
+import hashlib
+import io
+import logging
+import logging.handlers
 import os
-from flask import Flask, request, jsonify
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from flask import Flask, Response, request
 from flask_cors import CORS
-import google.generativeai as genai
+from limits import parse, storage, strategies
+from pythonjsonlogger.json import JsonFormatter
+from PIL import Image, ImageOps, UnidentifiedImageError
+from requests.adapters import HTTPAdapter
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:  # orjson has no PyPy build; fall back to the stdlib.
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    json_loads = json.loads
+
+try:
+    import numpy as np
+    import onnxruntime
+except ImportError:  # The local medical-image classifier is optional.
+    onnxruntime = None
 
 # --- Configuration ---
 
-# Load API key from environment variable for security.
-GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+# Log records go onto an in-memory queue; a background listener formats them as
+# JSON and writes to stderr, so request handlers never block on log I/O.
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger("app")
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
 
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set. Please configure it in your hosting environment.")
+# Load API keys from environment variables for security. GEMINI_API_KEYS is a
+# comma-separated pool; a single GEMINI_API_KEY is still accepted.
+GEMINI_API_KEYS = [
+    key.strip()
+    for key in os.environ.get("GEMINI_API_KEYS", os.environ.get("GEMINI_API_KEY", "")).split(",")
+    if key.strip()
+]
 
-genai.configure(api_key=GEMINI_API_KEY)
+if not GEMINI_API_KEYS:
+    raise ValueError("GEMINI_API_KEYS environment variable not set. Please configure it in your hosting environment.")
+
+# Keep-alive connections to Gemini held per key. Matches the Procfile's
+# --worker-connections so concurrent calls reuse TLS sessions instead of
+# opening new ones once the requests default of 10 is exceeded.
+GEMINI_POOL_MAXSIZE = int(os.environ.get("GEMINI_POOL_MAXSIZE", 100))
+
+# How long a key sits out after Gemini reports its quota exhausted.
+KEY_COOLDOWN_SECONDS = float(os.environ.get("KEY_COOLDOWN_SECONDS", 60))
+# Revoked or invalid keys are unlikely to recover soon, so they sit out longer.
+KEY_REJECTED_COOLDOWN_SECONDS = float(os.environ.get("KEY_REJECTED_COOLDOWN_SECONDS", 600))
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for frontend
+# Number of reverse proxies (e.g. Render's router) whose X-Forwarded-For may be
+# trusted for the client IP. Leave at 0 when clients connect directly, or the
+# header could be forged to dodge the per-IP rate limit.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+# Reject oversized bodies at the socket, before JSON parsing allocates them.
+app.config["MAX_CONTENT_LENGTH"] = 12 * 1024 * 1024
+# Enable CORS for the frontend. Set CORS_ORIGINS to the deployed frontend
+# origin(s), comma-separated; max_age lets browsers cache the preflight.
+CORS_ORIGINS = [origin.strip() for origin in os.environ.get("CORS_ORIGINS", "*").split(",") if origin.strip()]
+CORS(app, origins=CORS_ORIGINS, methods=["POST"], allow_headers=["Content-Type"], max_age=86400)
+
+MAX_IMAGE_BYTES = 8 * 1024 * 1024
+ALLOWED_MIME_TYPES = frozenset({"image/jpeg", "image/png", "image/webp"})
+# Optional local medical-vs-not classifier (ONNX, 224x224 RGB NCHW input,
+# ImageNet normalization, logits [not_medical, medical]). Images scoring below
+# the threshold are answered locally without calling Gemini.
+MEDICAL_CLASSIFIER_PATH = os.environ.get("MEDICAL_CLASSIFIER_PATH")
+MEDICAL_CLASSIFIER_THRESHOLD = float(os.environ.get("MEDICAL_CLASSIFIER_THRESHOLD", 0.15))
+
+if MEDICAL_CLASSIFIER_PATH and onnxruntime is None:
+    logger.warning("MEDICAL_CLASSIFIER_PATH is set but onnxruntime is not installed; classifier disabled.")
+
+# Larger images are downscaled and re-encoded as JPEG before upload to Gemini.
+MAX_IMAGE_DIMENSION = int(os.environ.get("MAX_IMAGE_DIMENSION", 1280))
+# Header-checked before decode: a tiny, highly compressible PNG can otherwise
+# expand to GBs of pixels and block the gevent worker while it is resized.
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 40_000_000))
 
 # Model configuration for Gemini API
 generation_config = {
@@ -44,52 +134,446 @@ Important Notes:
 - Always include disclaimer: "Consult with a Doctor before making any decisions."
 """
 
+# One model per API key, rotated round-robin. The pool is built once per worker
+# process, on first use, so it is never shared across a Gunicorn fork.
+_key_pool = None
+_key_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_genai():
+    """Import the Gemini SDK on first use, so worker boot and `/` don't pay for it."""
+    import google.generativeai as genai
+    return genai
+
+
+def build_model(api_key):
+    from google.ai import generativelanguage as glm
+
+    model = get_genai().GenerativeModel(
+        model_name="gemini-1.5-flash-latest",
+        generation_config=generation_config,
+        safety_settings=safety_setting,
+        system_instruction=system_prompt,
+    )
+    # genai.configure() holds a single global key, so each model gets its own
+    # client. The REST transport goes through `requests`, whose sockets gevent
+    # patches, so an in-flight Gemini call yields to other requests instead of
+    # blocking the worker like gRPC would.
+    client = glm.GenerativeServiceClient(transport="rest", client_options={"api_key": api_key})
+    client._transport._session.mount("https://", HTTPAdapter(pool_maxsize=GEMINI_POOL_MAXSIZE))
+    model._client = client
+    return model
+
+
+def acquire_key():
+    """Return the next key slot that is not cooling down, or None if all are."""
+    global _key_pool
+    with _key_pool_lock:
+        if _key_pool is None:
+            _key_pool = deque({"model": build_model(key), "cooldown_until": 0.0} for key in GEMINI_API_KEYS)
+        now = time.monotonic()
+        for _ in range(len(_key_pool)):
+            slot = _key_pool[0]
+            _key_pool.rotate(-1)
+            if slot["cooldown_until"] <= now:
+                return slot
+        return None
+
+
+def cool_down_key(slot, seconds=KEY_COOLDOWN_SECONDS):
+    with _key_pool_lock:
+        slot["cooldown_until"] = time.monotonic() + seconds
+
+
+def is_key_rejected(error):
+    """True if Gemini refused the API key itself rather than the request."""
+    from google.api_core import exceptions as gax
+
+    # An invalid key comes back as 400 INVALID_ARGUMENT with reason API_KEY_INVALID.
+    return isinstance(error, (gax.PermissionDenied, gax.Unauthenticated)) or getattr(error, "reason", None) == "API_KEY_INVALID"
+
+
+# Local rate limits, checked before calling Gemini so over-quota requests fail
+# fast. The global default is Gemini's free-tier 15 RPM per key. Limits are
+# service-wide: with the default in-memory storage each worker keeps its own
+# counters, so every limit is split evenly across WEB_CONCURRENCY workers.
+RATE_LIMIT_STORAGE_URI = os.environ.get("RATE_LIMIT_STORAGE_URI", "memory://")
+_rate_limit_storage = storage.storage_from_string(RATE_LIMIT_STORAGE_URI)
+_request_limiter = strategies.MovingWindowRateLimiter(_rate_limit_storage)
+
+_rate_limit_workers = int(os.environ.get("WEB_CONCURRENCY", 1)) if RATE_LIMIT_STORAGE_URI.startswith("memory://") else 1
+
+
+def parse_limit(value):
+    limit = parse(value)
+    return type(limit)(max(1, limit.amount // _rate_limit_workers), limit.multiples, limit.namespace)
+
+
+PER_IP_LIMIT = parse_limit(os.environ.get("RATE_LIMIT_PER_IP", "60/minute"))
+GLOBAL_LIMIT = parse_limit(os.environ.get("RATE_LIMIT_GLOBAL", f"{15 * len(GEMINI_API_KEYS)}/minute"))
+
+
+def within_rate_limits(client_ip):
+    """Consume one request from each limit, or none if any would be exceeded."""
+    checks = [(PER_IP_LIMIT, ("ip", client_ip)), (GLOBAL_LIMIT, ("global",))]
+    if not all(_request_limiter.test(limit, *ids) for limit, ids in checks):
+        return False
+    for limit, ids in checks:
+        _request_limiter.hit(limit, *ids)
+    return True
+
+
+# Like the key pool, the ONNX session is created lazily in each worker.
+_classifier = None
+_classifier_lock = threading.Lock()
+
+
+def get_classifier():
+    global _classifier
+    if _classifier is None and MEDICAL_CLASSIFIER_PATH and onnxruntime is not None:
+        with _classifier_lock:
+            if _classifier is None:
+                _classifier = onnxruntime.InferenceSession(MEDICAL_CLASSIFIER_PATH, providers=["CPUExecutionProvider"])
+    return _classifier
+
+
+# Exact-match cache of successful analyses, keyed by image hash + mime type.
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", 1024))
+_analysis_cache = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
+
+def cache_key(image_bytes, mime_type):
+    return hashlib.sha256(image_bytes).hexdigest() + ":" + mime_type
+
+
+def get_cached_analysis(key):
+    with _analysis_cache_lock:
+        analysis = _analysis_cache.get(key)
+        if analysis is not None:
+            _analysis_cache.move_to_end(key)
+        return analysis
+
+
+def store_analysis(key, analysis):
+    with _analysis_cache_lock:
+        _analysis_cache[key] = analysis
+        _analysis_cache.move_to_end(key)
+        while len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
+
+
+# Single-flight: concurrent misses for the same key wait on the first caller's
+# Gemini call instead of issuing their own. The future resolves to the full
+# analysis text, or None if the leader did not produce one. The future only
+# resolves once the leader's stream has finished, so the default wait covers a
+# full max_output_tokens generation at a conservative ~100 tokens/s.
+INFLIGHT_TIMEOUT_SECONDS = float(
+    os.environ.get("INFLIGHT_TIMEOUT_SECONDS", 30 + generation_config["max_output_tokens"] / 100)
+)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def join_inflight(key):
+    """Return (future, is_leader) for `key`, registering a new future if none is pending."""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future, False
+        future = _inflight[key] = Future()
+        return future, True
+
+
+def resolve_inflight(key, future, analysis):
+    """Publish the leader's result and release the key. Only the first call has effect."""
+    with _inflight_lock:
+        if future.done():
+            return
+        if _inflight.get(key) is future:
+            del _inflight[key]
+        future.set_result(analysis)
+
+
+def json_response(obj, status=200):
+    return app.response_class(json_dumps(obj), status=status, mimetype="application/json")
+
+
+def ndjson_line(obj):
+    return json_dumps(obj) + b"\n"
+
+
+# Bodies for the fixed validation errors, serialized once at import time.
+ERR_NOT_JSON = b'{"error":"Request must be JSON"}'
+ERR_MISSING_FIELDS = b'{"error":"Missing imageData or mimeType in request body"}'
+ERR_INVALID_BASE64 = b'{"error":"imageData is not valid base64"}'
+ERR_MISSING_FILE = b'{"error":"Missing image file in multipart body"}'
+ERR_EMPTY_FILE = b'{"error":"Empty image file"}'
+ERR_TOO_LARGE = b'{"error":"Image too large"}'
+ERR_UNSUPPORTED_MIME = json_dumps(
+    {"error": "Unsupported mimeType; expected one of " + ", ".join(sorted(ALLOWED_MIME_TYPES))}
+)
+ERR_INVALID_IMAGE = b'{"error":"Image could not be decoded"}'
+ERR_NO_USABLE_KEY = b'{"error":"No usable Gemini API key. Check the server configuration."}'
+ERR_RATE_LIMITED = b'{"error":"Rate limit exceeded. Try again later."}'
+
+NOT_MEDICAL_LINE = b'{"chunk":"Not a medical image."}\n'
+
+
+def static_error(body, status):
+    # A fresh Response per call: after_request hooks (flask-cors) mutate
+    # headers, so a shared Response object would accumulate them.
+    return app.response_class(body, status=status, mimetype="application/json")
+
+
+# --- Analysis ---
+
+def to_8bit(img):
+    """Rescale 16/32-bit integer images (e.g. radiograph PNGs) to 8-bit "L".
+
+    A plain convert("L"/"RGB") clips every value above 255 to white. The scale
+    comes from the image's own maximum, since 10-12-bit radiographs are usually
+    stored in a 16-bit container and a fixed 1/256 would leave them near black.
+    """
+    if img.mode.startswith("I"):
+        img = img.convert("I")
+        scale = 255 / max(img.getextrema()[1], 1)
+        img = img.point(lambda v: v * scale).convert("L")
+    return img
+
+
+def downscale_image(image_bytes, mime_type):
+    """Shrink images over MAX_IMAGE_DIMENSION to a JPEG; return (image, bytes, mime_type)."""
+    img = Image.open(io.BytesIO(image_bytes))
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(f"{width}x{height} exceeds MAX_IMAGE_PIXELS")
+    if max(img.size) <= MAX_IMAGE_DIMENSION:
+        return img, image_bytes, mime_type
+
+    # For JPEGs, let the decoder skip straight to a reduced DCT scale.
+    img.draft("RGB", (MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+    img = to_8bit(ImageOps.exif_transpose(img))
+    img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.LANCZOS)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85, optimize=False)
+    return img, buf.getvalue(), "image/jpeg"
+
+
+def medical_probability(img):
+    """Return the local classifier's P(medical) for `img`, or None if disabled."""
+    session = get_classifier()
+    if session is None:
+        return None
+
+    x = np.asarray(to_8bit(img).convert("RGB").resize((224, 224), Image.BILINEAR), dtype=np.float32) / 255.0
+    x = (x - np.array([0.485, 0.456, 0.406], dtype=np.float32)) / np.array([0.229, 0.224, 0.225], dtype=np.float32)
+    x = x.transpose(2, 0, 1)[np.newaxis]
+    logits = session.run(None, {session.get_inputs()[0].name: x})[0][0]
+    exp = np.exp(logits - logits.max())
+    return float(exp[1] / exp.sum())
+
+
+def stream_analysis(image_bytes, mime_type):
+    """Analyze raw image bytes, returning an NDJSON streaming response."""
+    key = cache_key(image_bytes, mime_type)
+
+    while True:
+        analysis = get_cached_analysis(key)
+        if analysis is not None:
+            return Response(ndjson_line({"chunk": analysis}), mimetype="application/x-ndjson")
+
+        future, is_leader = join_inflight(key)
+        if is_leader:
+            break
+        try:
+            analysis = future.result(timeout=INFLIGHT_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            # The leader is still streaming past the generation budget.
+            return run_analysis(key, image_bytes, mime_type)
+        if analysis is not None:
+            return Response(ndjson_line({"chunk": analysis}), mimetype="application/x-ndjson")
+        # The leader failed (often on quota); elect a new leader among the
+        # waiters rather than letting all of them call Gemini at once.
+
+    def on_done(analysis):
+        resolve_inflight(key, future, analysis)
+
+    try:
+        response = run_analysis(key, image_bytes, mime_type, on_done)
+    except BaseException:
+        on_done(None)
+        raise
+    # Covers every non-streaming return and a client that disconnects mid-stream.
+    response.call_on_close(lambda: on_done(None))
+    return response
+
+
+def run_analysis(key, image_bytes, mime_type, on_done=None):
+    """Call Gemini for a cache miss; `on_done` receives the full text or None once finished."""
+    if not within_rate_limits(request.remote_addr):
+        return static_error(ERR_RATE_LIMITED, 429)
+
+    try:
+        img, upload_bytes, upload_mime_type = downscale_image(image_bytes, mime_type)
+        p_medical = medical_probability(img)
+    except Image.DecompressionBombError:
+        return static_error(ERR_TOO_LARGE, 413)
+    except (UnidentifiedImageError, OSError):
+        return static_error(ERR_INVALID_IMAGE, 400)
+
+    if p_medical is not None and p_medical < MEDICAL_CLASSIFIER_THRESHOLD:
+        return Response(NOT_MEDICAL_LINE, mimetype="application/x-ndjson")
+
+    from google.api_core import exceptions as gax
+
+    image_parts = [{"mime_type": upload_mime_type, "data": upload_bytes}]
+    stream = None
+    quota_detail = "All API keys are cooling down after quota errors."
+    quota_hit = False
+    key_rejected = False
+
+    # On a quota or key error, park that key and retry with the next one in the pool.
+    for _ in range(len(GEMINI_API_KEYS)):
+        slot = acquire_key()
+        if slot is None:
+            break
+        try:
+            stream = slot["model"].generate_content(image_parts, stream=True)
+            break
+        # The REST transport maps HTTP 429 to TooManyRequests; ResourceExhausted
+        # is only its gRPC-side subclass, so catching that alone never matches.
+        except gax.TooManyRequests as e:
+            logger.warning("gemini_quota_exhausted")
+            cool_down_key(slot)
+            quota_detail = e.message
+            quota_hit = True
+        except gax.GoogleAPIError as e:
+            if is_key_rejected(e):
+                logger.error("gemini_key_rejected")
+                cool_down_key(slot, KEY_REJECTED_COOLDOWN_SECONDS)
+                key_rejected = True
+                continue
+            logger.exception("gemini_api_error")
+            return json_response({"error": f"Gemini API error: {e}", "backend_detail": str(e)}, 500)
+        except Exception as e:
+            logger.exception("gemini_error")
+            return json_response({"error": f"Unexpected backend error: {e}", "backend_detail": str(e)}, 500)
+
+    if stream is None:
+        if key_rejected and not quota_hit:
+            return static_error(ERR_NO_USABLE_KEY, 503)
+        return json_response({"error": "Quota exceeded. Try again later.", "backend_detail": quota_detail}, 429)
+
+    def generate():
+        """Yield one NDJSON line per Gemini chunk, caching the full text on success."""
+        chunks = []
+        analysis = None
+        try:
+            for chunk in stream:
+                chunks.append(chunk.text)
+                yield ndjson_line({"chunk": chunks[-1]})
+        except Exception as e:
+            logger.exception("gemini_stream_error")
+            error_details = str(e)
+            if stream.prompt_feedback:
+                error_details = f"Prompt feedback: {stream.prompt_feedback}"
+            yield ndjson_line({"error": "Failed to get analysis from Gemini API", "details": error_details})
+            return
+        else:
+            if chunks:
+                analysis = "".join(chunks)
+                store_analysis(key, analysis)
+            else:
+                yield ndjson_line({"error": "Failed to get analysis from Gemini API", "details": "No text in response."})
+        finally:
+            if on_done is not None:
+                on_done(analysis)
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
 # --- Routes ---
 
 @app.route("/")
 def home():
     """Health check route so Render doesn’t show 404"""
-    return jsonify({"status": "ok", "message": "Medical Image Analyzer Backend is running ✅"}), 200
+    return json_response({"status": "ok", "message": "Medical Image Analyzer Backend is running ✅"}, 200)
+
+@app.route("/analyze-image", methods=["OPTIONS"])
+@app.route("/analyze-image-raw", methods=["OPTIONS"])
+def preflight():
+    """Empty 204 for CORS preflights; flask-cors adds the Access-Control-* headers."""
+    return app.response_class(status=204)
 
 @app.route("/analyze-image", methods=["POST"])
 def analyze_image():
-    if not request.json:
-        return jsonify({"error": "Request must be JSON"}), 400
+    try:
+        payload = json_loads(request.get_data(cache=False))
+    except ValueError:  # orjson.JSONDecodeError, json.JSONDecodeError and UnicodeDecodeError
+        return static_error(ERR_NOT_JSON, 400)
+    if not payload or not isinstance(payload, dict):
+        return static_error(ERR_NOT_JSON, 400)
 
-    image_data_base64 = request.json.get("imageData")
-    mime_type = request.json.get("mimeType")
+    image_data_base64 = payload.get("imageData")
+    mime_type = payload.get("mimeType")
 
     if not image_data_base64 or not mime_type:
-        return jsonify({"error": "Missing imageData or mimeType in request body"}), 400
+        return static_error(ERR_MISSING_FIELDS, 400)
+
+    # JSON can hand us a list or object here; those are unhashable in the set lookup.
+    if not isinstance(mime_type, str):
+        return static_error(ERR_UNSUPPORTED_MIME, 415)
+
+    if mime_type not in ALLOWED_MIME_TYPES:
+        return static_error(ERR_UNSUPPORTED_MIME, 415)
+
+    if not isinstance(image_data_base64, str):
+        return static_error(ERR_INVALID_BASE64, 400)
+
+    # Accept data URLs ("data:image/png;base64,...") as sent by FileReader.
+    if image_data_base64.startswith("data:"):
+        image_data_base64 = image_data_base64.partition(",")[2]
+
+    if (len(image_data_base64) * 3) // 4 > MAX_IMAGE_BYTES:
+        return static_error(ERR_TOO_LARGE, 413)
 
     try:
-        image_parts = [{"mime_type": mime_type, "data": image_data_base64}]
-        prompt_parts = [image_parts[0], system_prompt]
+        # The C decoder directly, without base64.b64decode's Python-level wrapper.
+        image_bytes = binascii.a2b_base64(image_data_base64)
+    except (binascii.Error, ValueError):
+        return static_error(ERR_INVALID_BASE64, 400)
 
-        model = genai.GenerativeModel(
-            model_name="gemini-1.5-flash-latest",
-            generation_config=generation_config,
-            safety_settings=safety_setting,
-        )
+    return stream_analysis(image_bytes, mime_type)
 
-        response = model.generate_content(prompt_parts)
 
-        if response and response.text:
-            return jsonify({"analysis": response.text}), 200
-        else:
-            error_details = "No text in response."
-            if response and response.prompt_feedback:
-                error_details = f"Prompt feedback: {response.prompt_feedback}"
-            return jsonify({"error": "Failed to get analysis from Gemini API", "details": error_details}), 500
+@app.route("/analyze-image-raw", methods=["POST"])
+def analyze_image_raw():
+    """Same as /analyze-image, but takes the image as a multipart upload."""
+    image_file = request.files.get("image")
+    if image_file is None:
+        return static_error(ERR_MISSING_FILE, 400)
+
+    mime_type = image_file.mimetype
+    if mime_type not in ALLOWED_MIME_TYPES:
+        return static_error(ERR_UNSUPPORTED_MIME, 415)
+
+    image_bytes = image_file.read()
+    if not image_bytes:
+        return static_error(ERR_EMPTY_FILE, 400)
+    if len(image_bytes) > MAX_IMAGE_BYTES:
+        return static_error(ERR_TOO_LARGE, 413)
 
-    except Exception as e:
-        print(f"Backend Error: {e}")
-        if "ResourceExhausted" in str(e):
-            return jsonify({"error": "Quota exceeded. Try again later.", "backend_detail": str(e)}), 429
-        return jsonify({"error": f"Unexpected backend error: {str(e)}", "backend_detail": str(e)}), 500
+    return stream_analysis(image_bytes, mime_type)
 
 
 # --- Server Start ---
+# Production runs under Gunicorn with gevent workers (see Procfile).
+# This block is only for local development.
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=os.environ.get("FLASK_DEBUG") == "1", host="0.0.0.0", port=port)